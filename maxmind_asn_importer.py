@@ -11,17 +11,27 @@ Property of: Cisco Systems
 """
 
 import argparse
-import csv
+import array
 import getpass
-import json
+import hashlib
+import io
+import logging
 import os
+import pickle
 import shutil
+import socket
 import time
 import zipfile
+import ahocorasick
+import orjson
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+
 from stealthwatch_client import StealthwatchClient
 
+logger = logging.getLogger(__name__)
+
 # Config Parameters
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
 CONFIG_FILE_EXAMPLE = os.path.join(os.path.dirname(__file__), 'config.example.json')
@@ -29,6 +39,24 @@ CONFIG_DATA = {}
 
 ZIP_FILE_NAME = "maxmind_data.zip"
 
+# The parsed MaxMind data from the last download, so it doesn't need to be parsed again
+CACHE_FILE_NAME = "maxmind_cache.pkl"
+
+# The CSV files to search within the MaxMind data
+CSV_FILE_NAMES = {"GeoLite2-ASN-Blocks-IPv4.csv", "GeoLite2-ASN-Blocks-IPv6.csv"}
+
+# Size (in bytes) of each chunk written to disk while downloading from MaxMind
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Size (in bytes) of the read buffer used when streaming the CSVs out of the MaxMind data
+CSV_BUFFER_SIZE = 1 << 20
+
+# Most ASN or description keywords to check inline in the generated matcher, before falling back to a lookup
+MATCHER_INLINE_LIMIT = 8
+
+# Number of Tags (Host Groups) uploaded to Stealthwatch at once
+UPLOAD_WORKERS = 16
+
 # Set a wait interval (in seconds) - Default is one day
 INTERVAL = 86400
 
@@ -47,8 +75,8 @@ def load_config(retry=False):
     if os.path.isfile(CONFIG_FILE):
 
         # Open the CONFIG_FILE and load it
-        with open(CONFIG_FILE, "r") as config_file:
-            CONFIG_DATA = json.loads(config_file.read())
+        with open(CONFIG_FILE, "rb") as config_file:
+            CONFIG_DATA = orjson.loads(config_file.read())
 
         print("Configuration data loaded successfully.")
 
@@ -74,30 +102,49 @@ def load_config(retry=False):
 def save_config():
     """Save configuration data to file."""
 
-    with open(CONFIG_FILE, "w") as output_file:
-        json.dump(CONFIG_DATA, output_file, indent=4)
+    with open(CONFIG_FILE, "wb") as output_file:
+        output_file.write(orjson.dumps(CONFIG_DATA, option=orjson.OPT_INDENT_2))
 
 
 def get_current_version():
-    """Retrieve the latest version number of the MaxMind ASN database."""
+    """Retrieve the latest version number of the MaxMind ASN database, along with its ETag and Last-Modified headers."""
 
     # Build the URL to request
     url = CONFIG_DATA["MAXMIND_VERSION_URL"] + "&license_key=" + CONFIG_DATA["MAXMIND_LICENSE_KEY"]
 
-    try:
-        # Fetch the version info from MaxMind
-        response = requests.get(url)
+    last_etag = CONFIG_DATA.get("LAST_ETAG", "")
+    last_modified = CONFIG_DATA.get("LAST_MODIFIED", "")
 
-        # Check to make sure the GET was successful
-        if response.status_code == 200:
+    # If we've imported data before, only ask MaxMind for the version if it has changed
+    headers = {}
 
-            # Return the md5 of the current ASN database file
-            return response.content.decode('ascii')
+    if CONFIG_DATA["LAST_VERSION_IMPORTED"]:
+        if last_etag:
+            headers["If-None-Match"] = last_etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    try:
+        # Fetch the version info from MaxMind
+        response = requests.get(url, headers=headers)
 
     except Exception as err:
         print("Error fetching version info from MaxMind: " + str(err))
         exit(1)
 
+    # If nothing has changed, then the last imported version is still current
+    if response.status_code == 304:
+        return CONFIG_DATA["LAST_VERSION_IMPORTED"], last_etag, last_modified
+
+    # Check to make sure the GET was successful
+    if response.status_code == 200:
+
+        # Return the md5 of the current ASN database file
+        return response.content.decode('ascii'), response.headers.get("ETag", ""), response.headers.get("Last-Modified", "")
+
+    print("Failed to get version info from MaxMind.\nHTTP Return Code: {}".format(response.status_code))
+    exit(1)
+
 
 def get_new_addresses():
     """Retrieve the latest IP address data from MaxMind and save the file."""
@@ -108,124 +155,324 @@ def get_new_addresses():
     url = CONFIG_DATA["MAXMIND_DATASET_URL"] + "&license_key=" + CONFIG_DATA["MAXMIND_LICENSE_KEY"]
 
     try:
-        # Get the latest address feed from MaxMind
-        response = requests.get(url, allow_redirects=True)
-
-        # If the request was successful
-        if response.status_code >= 200 or response.status_code < 300:
+        # Get the latest address feed from MaxMind, without reading the whole body into memory
+        with requests.get(url, allow_redirects=True, stream=True) as response:
 
-            # Write downloaded zip file to disk
-            open(ZIP_FILE_NAME, 'wb').write(response.content)
+            # If the request was unsuccessful, then raise an error
+            response.raise_for_status()
 
-        else:
-            print("Failed to get data from MaxMind. Terminating.")
-            exit()
+            # Write downloaded zip file to disk in chunks
+            with open(ZIP_FILE_NAME, 'wb') as zip_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    zip_file.write(chunk)
 
     except Exception as err:
         print("Unable to get the MaxMind ASN data - Error: {}".format(err))
         exit()
 
 
-def search_maxmind_data():
-    """Unzip the fetched MaxMind data, search it, then return the Org-to-IP mappings."""
+def build_search_index(search_data):
+    """Index the search keywords into an ASN lookup table and a description keyword automaton."""
 
-    print("Unzipping downloaded files...")
+    # Map each ASN to the (org, keyword) pairs that want it
+    asn_lookup = {}
 
-    file_list = []
+    # Load the description keywords into an Aho-Corasick automaton, which acts as a trie over all of them
+    automaton = ahocorasick.Automaton()
 
-    # Unzip the file from MaxMind
-    try:
-        with zipfile.ZipFile(ZIP_FILE_NAME, "r") as z:
-            file_names = z.namelist()
+    for org, keywords in search_data.items():
+        for keyword in keywords:
+
+            # Check to see if the keyword is an ASN number
+            if keyword.isnumeric():
+                asn_lookup.setdefault(keyword, []).append((org, keyword))
+            else:
+                # Several orgs may share the same keyword, so each word holds a list of matches
+                if automaton.exists(keyword.lower()):
+                    automaton.get(keyword.lower()).append((org, keyword))
+                else:
+                    automaton.add_word(keyword.lower(), [(org, keyword)])
+
+    # An automaton without any words can't be searched
+    if len(automaton):
+        automaton.make_automaton()
+
+    return asn_lookup, automaton
+
+
+def compile_matcher(search_data):
+    """Generate a match(asn, description) function specialized to the search keywords."""
+
+    asn_lookup, automaton = build_search_index(search_data)
+
+    # The description keywords, along with the (org, keyword) pairs that want them
+    keywords = list(automaton.items()) if len(automaton) else []
+
+    source = [
+        "def match(asn, description):",
+        "    hits = []"
+    ]
+
+    # Inline the ASN checks if there are only a few, otherwise use the lookup table
+    if len(asn_lookup) <= MATCHER_INLINE_LIMIT:
+        for asn, asn_hits in asn_lookup.items():
+            source.append("    if asn == {!r}:".format(asn))
+            source.append("        hits.extend({!r})".format(asn_hits))
+    else:
+        source.append("    hits.extend(asn_lookup.get(asn, ()))")
+
+    if keywords:
+        source.append("    description = description.lower()")
+
+    # Inline the description checks if there are only a few, otherwise scan with the automaton
+    if len(keywords) <= MATCHER_INLINE_LIMIT:
+        for keyword, keyword_hits in keywords:
+            source.append("    if {!r} in description:".format(keyword))
+            source.append("        hits.extend({!r})".format(keyword_hits))
+    else:
+        source.append("    hits.extend({hit for _, matches in automaton.iter(description) for hit in matches})")
+
+    source.append("    return hits")
+
+    # Compile the function, giving it access to the search index
+    namespace = {"asn_lookup": asn_lookup, "automaton": automaton}
+    exec("\n".join(source), namespace)
+
+    return namespace["match"]
+
+
+def parse_csv_rows(csv_file, asn_index):
+    """Parse the rows of a MaxMind CSV, adding the IP ranges for each ASN and description to the index."""
+
+    raw_index = {}
+
+    # Go through each row of the CSV once, grouping the ranges by the raw ASN and description
+    for line in csv_file:
+
+        # Split the network and ASN off, leaving any commas in the description intact
+        fields = line.rstrip(b'\r\n').split(b',', 2)
+
+        if len(fields) < 3:
+            continue
+
+        network, asn, description = fields
+
+        # Add the IP range to the ASN's array
+        raw_index.setdefault((asn, description), []).append(network.decode("ascii"))
+
+    # Decode each unique ASN and description only once
+    for (asn, description), ranges in raw_index.items():
 
-            for file_name in file_names:
-                if '.csv' in file_name:
-                    file_list.append(file_name)
-                    z.extract(file_name, "temp_csv")
+        # Undo any CSV quoting on the description, including escaped (doubled) quotes
+        if description.startswith(b'"'):
+            description = description[1:-1].replace(b'""', b'"')
+
+        key = (asn.decode("ascii"), description.decode("ISO-8859-1"))
+
+        asn_index.setdefault(key, []).extend(ranges)
+
+
+def parse_maxmind_data():
+    """Parse the CSVs in the fetched MaxMind data, then return the IP ranges for each ASN and description."""
+
+    print("Unzipping downloaded files...")
+
+    # Find the ASN CSV files in the file from MaxMind
+    try:
+        with zipfile.ZipFile(ZIP_FILE_NAME, "r") as zip_file:
+            file_list = [file_name for file_name in zip_file.namelist() if os.path.basename(file_name) in CSV_FILE_NAMES]
 
     except Exception as err:
         print("Failed to unzip the file downloaded from MaxMind.  Check the file and MaxMind API key.")
         exit(1)
 
-    return_data = []
+    asn_index = {}
+
+    with zipfile.ZipFile(ZIP_FILE_NAME, "r") as zip_file:
+        for file_name in file_list:
+
+            print("Opening {}...".format(file_name))
+
+            # Read the CSV file as raw bytes, through a large buffer
+            with io.BufferedReader(zip_file.open(file_name), buffer_size=CSV_BUFFER_SIZE) as csv_file:
+
+                # Skip the header row
+                csv_file.readline()
+
+                parse_csv_rows(csv_file, asn_index)
+
+    # Clean up the Zip file
+    os.remove(ZIP_FILE_NAME)
+
+    return asn_index
+
+
+def build_range_table(asn_index):
+    """Convert the parsed MaxMind data into sorted integer start, end, and ASN arrays for each IP version."""
+
+    rows = {4: [], 6: []}
+
+    # Convert each IP range into its first and last addresses as integers, straight from the CIDR string
+    for (asn, description), ranges in asn_index.items():
+        for network in ranges:
+            address, prefix = network.split("/")
+
+            if ":" in address:
+                version, bits, family = 6, 128, socket.AF_INET6
+            else:
+                version, bits, family = 4, 32, socket.AF_INET
+
+            start = int.from_bytes(socket.inet_pton(family, address), "big")
+            end = start | ((1 << (bits - int(prefix))) - 1)
+
+            rows[version].append((start, end, int(asn)))
+
+    range_table = {}
+
+    for version, version_rows in rows.items():
+
+        # Sort the ranges by their first address, so they can be binary searched
+        version_rows.sort()
+
+        starts = [row[0] for row in version_rows]
+        ends = [row[1] for row in version_rows]
+
+        # IPv4 addresses fit in packed 32-bit arrays, but IPv6 addresses need Python integers
+        if version == 4:
+            starts = array.array("I", starts)
+            ends = array.array("I", ends)
+
+        range_table[version] = {
+            "starts": starts,
+            "ends": ends,
+            "asns": array.array("I", [row[2] for row in version_rows])
+        }
+
+    return range_table
+
+
+def load_maxmind_cache(version):
+    """Load the parsed MaxMind data from the cache file, if it matches the given version."""
+
+    try:
+        with open(CACHE_FILE_NAME, "rb") as cache_file:
+            cache = pickle.load(cache_file)
+
+    except Exception as err:
+        return None
+
+    # Only use the cache if it was built from this version of the MaxMind data
+    if cache.get("version") != version:
+        return None
+
+    print("Loaded parsed MaxMind data from {}.".format(CACHE_FILE_NAME))
+
+    return cache["asn_index"]
+
+
+def save_maxmind_cache(version, asn_index):
+    """Save the parsed MaxMind data, along with its range table, to the cache file."""
+
+    cache = {
+        "version": version,
+        "asn_index": asn_index,
+        "range_table": build_range_table(asn_index)
+    }
+
+    with open(CACHE_FILE_NAME, "wb") as cache_file:
+        pickle.dump(cache, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
 
-    # Go through each "search" entry from the config.json
-    for org, keywords in CONFIG_DATA['SEARCH_DATA'].items():
 
-        # Create an placeholder for the org data
-        org_data = {
+def search_maxmind_data(asn_index):
+    """Search the parsed MaxMind data, then return the Org-to-IP mappings."""
+
+    # Build a matcher for the keywords from the config.json once, up front
+    match = compile_matcher(CONFIG_DATA['SEARCH_DATA'])
+
+    # Create a placeholder for each org's data
+    org_data = {}
+
+    for org in CONFIG_DATA['SEARCH_DATA']:
+        org_data[org] = {
             "name": org,
-            "ranges": []
+            "ranges": set()
         }
 
-        print("Getting IP ranges for {}...".format(org))
+    # Go through each ASN and description once, checking it against every keyword
+    for (asn, description), ranges in asn_index.items():
+        for org, keyword in match(asn, description):
 
-        # Iterate through each CSV file
-        for file_name in file_list:
+            # Add the IP ranges to our set
+            org_data[org]["ranges"].update(ranges)
 
-            print("Opening {}...".format(file_name))
+            # Log details about the find
+            logger.debug("Found %d IP ranges for %s with keyword '%s' in ASN %s '%s'", len(ranges), org, keyword, asn, description)
 
-            # Open the CSV file and parse it
-            with open("temp_csv/" + file_name, "r", encoding="ISO-8859-1") as csvfile:
+    # Sort each org's unique ranges for upload
+    for org in org_data.values():
+        org["ranges"] = sorted(org["ranges"])
 
-                # Set up the CSV Reader
-                csv_reader = csv.reader(csvfile)
+    return list(org_data.values())
 
-                # Iterate through each keyword specified for the Host Group
-                for keyword in keywords:
 
-                    # Reset back to the beginning of the CSV
-                    csvfile.seek(0)
+def upload_org(stealthwatch, tag_index, range_hashes, org):
+    """Create or update the Tag (Host Group) for an org with its latest IP ranges."""
 
-                    # Go through each row of the CSV
-                    for row in csv_reader:
+    # Make a Tag ID placeholder
+    tag_id = 0
 
-                        # Check to see if the keyword is an ASN number
-                        if keyword.isnumeric():
+    # If the Tag name is found, update the tag_id placeholder
+    for current_tag in tag_index.get(org["name"], []):
 
-                            # If the keyword is in the description, then add it to our array
-                            if keyword == row[1]:
+        # Get the found Tag
+        response = stealthwatch.get_tag(current_tag["id"])
 
-                                # Add the IP range to our array
-                                org_data["ranges"].append(row[0])
+        # Get the parent of the found tag
+        parent_tag = response["data"]["parentId"]
 
-                                # Print details about the find
-                                print("Found IP range {} for {} with ASN '{}'".format(row[0], org, keyword))
+        # If the parent is the one we want
+        if parent_tag == int(CONFIG_DATA["SW_PARENT_TAG"]):
 
-                        else:
+            # Use the tag ID to update
+            tag_id = current_tag["id"]
+            break
 
-                            # If the keyword is in the description, then add it to our array
-                            if keyword.lower() in row[2].lower():
+    # Hash the org's ranges, so we can tell if they changed since the last import
+    range_hash = hashlib.sha1("\n".join(sorted(org["ranges"])).encode()).hexdigest()
 
-                                # Add the IP range to our array
-                                org_data["ranges"].append(row[0])
+    if tag_id and range_hashes.get(org["name"]) == range_hash:
 
-                                # Print details about the find
-                                print("Found IP range {} for {} with keyword '{}' in '{}'".format(row[0], org, keyword, row[2]))
+        print("Tag ID {} for Org {} is unchanged, skipping...".format(tag_id, org["name"]))
+        return
 
-        # Append the org data to the return data
-        return_data.append(org_data)
+    if tag_id:
 
-    # Clean up the extracted files
-    shutil.rmtree("temp_csv")
+        print("Updating Tag ID {} for Org {}...".format(tag_id, org["name"]))
 
-    # Clean up the Zip file
-    os.remove(ZIP_FILE_NAME)
+        # Update the Tag (Host Group) with the latest data
+        stealthwatch.update_tag(CONFIG_DATA["SW_PARENT_TAG"], tag_id, org["name"], org["ranges"])
+    else:
+
+        print("Creating Tag for Org {}...".format(org["name"]))
 
-    return return_data
+        # Create a new Tag (Host Group) for the org
+        stealthwatch.create_tag(CONFIG_DATA["SW_PARENT_TAG"], org["name"], org["ranges"])
+
+    # Remember the ranges that were uploaded
+    range_hashes[org["name"]] = range_hash
 
 
 def main():
     """This is a function to run the main logic of the MaxMind ASN Importer."""
 
     # Get the latest version of the feed from MaxMind
-    current_version = get_current_version()
+    current_version, etag, last_modified = get_current_version()
 
     # If the latest version is not equal to last imported version, then import the new stuff
     if current_version != CONFIG_DATA["LAST_VERSION_IMPORTED"]:
 
         # Instantiate a new StealthwatchClient
-        stealthwatch = StealthwatchClient(validate_certs=False)
+        stealthwatch = StealthwatchClient(validate_certs=False, pool_size=UPLOAD_WORKERS)
 
         # Login to Stealthwatch
         stealthwatch.login(CONFIG_DATA["SW_ADDRESS"], CONFIG_DATA["SW_USERNAME"], CONFIG_DATA["SW_PASSWORD"])
@@ -252,62 +499,57 @@ def main():
             CONFIG_DATA["SW_PARENT_TAG"] = response["data"][0]["id"]
             save_config()
 
-        # Get the latest ASN data from MaxMind
-        get_new_addresses()
+        # Use the parsed MaxMind data from an earlier run of this version, if there is one
+        asn_index = load_maxmind_cache(current_version)
+
+        if asn_index is None:
+
+            # Get the latest ASN data from MaxMind
+            get_new_addresses()
+
+            # Parse the latest MaxMind data, and cache it
+            asn_index = parse_maxmind_data()
+            save_maxmind_cache(current_version, asn_index)
 
         # Search through the latest MaxMind data
-        current_asn_data = search_maxmind_data()
+        current_asn_data = search_maxmind_data(asn_index)
 
         print("Getting Tags from Stealthwatch...")
 
         # Get all of the Tags (Host Groups) from Stealthwatch
         current_tags = stealthwatch.get_tags()
 
-        print("Uploading Tag data to Stealthwatch...")
-
-        # Iterate through the returned MaxMind data
-        for org in current_asn_data:
+        # Index the Tags by name, since the same name may be used under different parents
+        tag_index = {}
 
-            # Make a Tag ID placeholder
-            tag_id = 0
+        for current_tag in current_tags["data"]:
+            tag_index.setdefault(current_tag["name"], []).append(current_tag)
 
-            # If the Tag name is found, update the tag_id placeholder
-            for current_tag in current_tags["data"]:
-                if current_tag["name"] == org["name"]:
+        # Get the hashes of each org's ranges from the last import
+        range_hashes = CONFIG_DATA.setdefault("ORG_RANGE_HASHES", {})
 
-                    # Get the found Tag
-                    response = stealthwatch.get_tag(current_tag["id"])
-
-                    # Get the parent of the found tag
-                    parent_tag = response["data"]["parentId"]
-
-                    # If the parent is the one we want
-                    if parent_tag is int(CONFIG_DATA["SW_PARENT_TAG"]):
-
-                        # Use the tag ID to update
-                        tag_id = current_tag["id"]
-                        break
-
-            if tag_id:
-
-                print("Updating Tag ID {} for Org {}...".format(tag_id, org["name"]))
-
-                # Update the Tag (Host Group) with the latest data
-                stealthwatch.update_tag(CONFIG_DATA["SW_PARENT_TAG"], tag_id, org["name"], org["ranges"])
-            else:
-
-                print("Creating Tag for Org {}...".format(org["name"]))
+        print("Uploading Tag data to Stealthwatch...")
 
-                # Create a new Tag (Host Group) for the org
-                stealthwatch.create_tag(CONFIG_DATA["SW_PARENT_TAG"], org["name"], org["ranges"])
+        # Upload the returned MaxMind data, several orgs at a time
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            list(executor.map(lambda org: upload_org(stealthwatch, tag_index, range_hashes, org), current_asn_data))
 
-        # Update the latest imported version
+        # Update the latest imported version, and the headers used to check it next time
         CONFIG_DATA["LAST_VERSION_IMPORTED"] = current_version
+        CONFIG_DATA["LAST_ETAG"] = etag
+        CONFIG_DATA["LAST_MODIFIED"] = last_modified
         save_config()
 
         print("MaxMind addresses successfully imported.")
 
     else:
+
+        # Keep the latest headers, so the next check can still get a 304 if MaxMind re-published the same version
+        if etag != CONFIG_DATA.get("LAST_ETAG", "") or last_modified != CONFIG_DATA.get("LAST_MODIFIED", ""):
+            CONFIG_DATA["LAST_ETAG"] = etag
+            CONFIG_DATA["LAST_MODIFIED"] = last_modified
+            save_config()
+
         print("Last imported data is up-to-date.")
         return
 
@@ -323,8 +565,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="A script to import MaxMind ASN data into Stealthwatch")
     parser.add_argument("-f", "--file", help="Configuration file to use (Default: config.json)" )
     parser.add_argument("-d", "--daemon", help="Run the script as a daemon", action="store_true")
+    parser.add_argument("-v", "--verbose", help="Print the IP ranges found for each organization", action="store_true")
     args = parser.parse_args()
 
+    # Only log the individual IP ranges found if asked to
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+
     # If a different config file is specified, use it
     if args.file:
         CONFIG_FILE = args.file
@@ -351,8 +597,15 @@ if __name__ == "__main__":
 
     if args.daemon:
         while True:
+            start_time = time.monotonic()
+
             main()
-            print("Waiting {} seconds...".format(INTERVAL))
-            time.sleep(INTERVAL)
+
+            # Wait out the rest of the interval, counting the time spent importing
+            wait_time = INTERVAL - (time.monotonic() - start_time)
+
+            if wait_time > 0:
+                print("Waiting {:.0f} seconds...".format(wait_time))
+                time.sleep(wait_time)
     else:
         main()
@@ -11,8 +11,10 @@ Property of: Cisco Systems
 
 import json
 
+import orjson
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.packages import urllib3
 
 try:
@@ -30,11 +32,12 @@ class StealthwatchClient:
     __smc_password = None
     __tenant_id = None
     __validate_certs = None
+    __pool_size = None
     __version = None
 
     __debug = False
 
-    def __init__(self, debug=False, validate_certs=True, *args, **kwargs):
+    def __init__(self, debug=False, validate_certs=True, pool_size=10, *args, **kwargs):
         """Initialize the Stealthwatch Client object."""
 
         if self.__session is not None:
@@ -44,6 +47,7 @@ class StealthwatchClient:
         self.__smc_password = None
         self.__tenant_id = None
         self.__validate_certs = validate_certs
+        self.__pool_size = pool_size
         self.__version = None
 
         self.__debug = debug
@@ -61,6 +65,10 @@ class StealthwatchClient:
             self.__session.close()
         self.__session = requests.Session()
 
+        # Keep enough connections open to the SMC for concurrent requests
+        adapter = HTTPAdapter(pool_connections=self.__pool_size, pool_maxsize=self.__pool_size)
+        self.__session.mount("https://", adapter)
+
         access_token = self.get_access_token()
 
         # Set the version
@@ -124,7 +132,7 @@ class StealthwatchClient:
         # Get Tag data from Stealthwatch
         response = self._get_request(url, json=data)
 
-        return response.json()
+        return orjson.loads(response.content)
     
     def get_tag(self, tag_id):
         """Get a Tag (Host Group) from Stealthwatch"""
@@ -138,7 +146,7 @@ class StealthwatchClient:
         # Post Tag data to Stealthwatch
         response = self._get_request(url)
 
-        return response.json()
+        return orjson.loads(response.content)
 
     def create_tag(self, parent_tag_id, tag_name, ip_list=[], host_baselines=False,
                    suppress_excluded_services=True, inverse_suppression=False, host_trap=False, send_to_cta=False):
@@ -165,7 +173,7 @@ class StealthwatchClient:
         # Post Tag data to Stealthwatch
         response = self._post_request(url, json=data)
 
-        return response.json()
+        return orjson.loads(response.content)
 
     def update_tag(self, parent_tag_id, tag_id, tag_name, ip_list=[], host_baselines=False,
                    suppress_excluded_services=True, inverse_suppression=False, host_trap=False, send_to_cta=False):
@@ -193,7 +201,7 @@ class StealthwatchClient:
         # Post Tag update to Stealthwatch
         response = self._put_request(url, json=data)
 
-        return response.json()
+        return orjson.loads(response.content)
 
     def get_tenant_id(self):
         """Gets the current Tenant ID being used by the object."""
@@ -215,7 +223,7 @@ class StealthwatchClient:
         response = self._get_request(url)
 
         # Parse the response as JSON
-        tenants = response.json()["data"]
+        tenants = orjson.loads(response.content)["data"]
 
         # Set the Domain ID if theres only one, or prompt the user if there are multiple
         if len(tenants) == 1:
@@ -238,7 +246,7 @@ class StealthwatchClient:
 
         try:
             # Iterate through all the appliances
-            for appliance in response.json():
+            for appliance in orjson.loads(response.content):
 
                 # If we found the referenced SMC
                 if appliance["applianceType"] == "SMC":